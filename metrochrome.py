@@ -8,7 +8,20 @@
 # values.
 #
 
+import bisect
+import hashlib
+import itertools
+import json
+import math
+import os
+import random
+import re
+import shutil
 import sys
+import tempfile
+import zlib
+from array import array
+from collections import Counter
 
 class InvalidColorException(Exception):
     """Exception indicates inputs to a color class are out of range for the color space"""
@@ -215,7 +228,7 @@ class HSLColor:
             return False
 
 class CIEColor:
-    """A color represented in CIE color space"""
+    """A color represented in CIE 1931 XYZ color space, scaled so the white point has Y of 1"""
     def __init__(self, x, y, z):
         self.x = x
         self.y = y
@@ -240,7 +253,7 @@ class CIEColor:
         x = self.x
         y = self.y
         z = self.z
-        if x < 0.0 or x > 1.0 or y < 0.0 or y > 1.0 or z < 0.0 or z > 1.0:
+        if x < 0.0 or x > 1.5 or y < 0.0 or y > 1.0 or z < 0.0 or z > 1.5:
             return True
         else:
             return False
@@ -316,11 +329,147 @@ metrochrome.py - a command line tool for exploring color
     -rgbh = RGB in hexadecimal format with a leading hash mark (e.g. #00FF30)
     -cmyk = CMYK color space 4 space separated percentages from 0 to 100 such as 0 100 95.5 82.7
     -cmykr = CMYK in percent format 4 space separated ratio values 0 to 1 such as 0 1 0.955 0.827
+    -hsv = HSV color space written as hue 0-360, saturation 0-1 and value 0-1
+    -hsl = HSL color space written as hue 0-360, saturation 0-1 and lightness 0-1
+    -cie = CIE XYZ color space relative to D65 white, written as three values such as 0.950 1.000 1.089
 
     examples:
     metrochrome.py -rgb 0 0 0 -cmyk        # converts RGB to CMYK and prints (0, 0, 0, 1)
     metrochrome.py -rgb 255 255 255 -rgbh  # converts RGB to hexadecimal and prints #FFFFFF
     metrochrome.py -cmyk (0, 1, 0.955, 0.827) -rgb  # converts CMYK to RGB and prints #FFFFFF
+
+* Bake a 3D LUT (.cube file) *
+    metrochrome.py -lut <size> <adjustments> <out_file>
+
+    size is the number of lattice points per axis, commonly 17, 33 or 65
+
+    adjustments are applied in order:
+    -hue <degrees> = rotate hue in HSV color space
+    -saturation <factor> = scale HSV saturation
+    -value <factor> = scale HSV value
+    -lightness <factor> = scale HSL lightness
+    -via <color_space> = convert to -cmyk, -cmykr, -hsv, -hsl or -cie and back to RGB
+
+    examples:
+    metrochrome.py -lut 33 -hue 30 -saturation 1.2 warm.cube
+
+* Apply a 3D LUT to an image *
+    metrochrome.py -applylut <lut_file> <in_image> <out_image> [-tetrahedral | -trilinear]
+
+    images are binary PPM (P6) files, or raw 24 bit RGB pixels when named .raw or .rgb
+    tetrahedral interpolation is used unless -trilinear is given
+
+    examples:
+    metrochrome.py -applylut warm.cube photo.ppm warm.ppm
+
+* Extract the dominant colors of an image *
+    metrochrome.py -palette <count> <in_image> [-mediancut | -kmeans] [-lab] [-sample <stride>]
+
+    -mediancut = split the color histogram at weighted medians (default)
+    -kmeans = refine the median cut colors with mini-batch k-means
+    -lab = measure color distances in CIE L*a*b* rather than RGB
+    -sample = only read every stride-th pixel (by default about a million pixels are sampled)
+
+    examples:
+    metrochrome.py -palette 16 photo.ppm -kmeans -lab
+
+* Histogram and statistics of colors in HSV or HSL color space *
+    metrochrome.py -histogram <-hsv | -hsl> <in_file> [-bins <hue> <saturation> <value>] [-binary <out_file>]
+
+    in_file is an image (.ppm, .pnm, .raw or .rgb) or a list of colors, one per line, written
+    as RGB hexadecimal or three RGB values; use - to read the list from standard input
+    -bins = number of bins for each channel (default 36 10 10)
+    hue statistics are circular and leave out achromatic colors (zero saturation), which are counted separately
+    -binary = write the bin counts and achromatic count as little endian unsigned 64 bit integers
+              followed by the circular mean and variance of hue and the mean and variance of
+              the other channels as doubles instead of printing JSON
+
+    examples:
+    metrochrome.py -histogram -hsv frame.ppm
+
+* Dither an image to a palette *
+    metrochrome.py -dither <in_image> <out_image> [-floydsteinberg | -atkinson] [-width <pixels>] <hex_color> ...
+
+    the palette is a list of up to 256 RGB hexadecimal colors
+    -width is required for raw (.raw or .rgb) images
+
+    examples:
+    metrochrome.py -dither photo.ppm poster.ppm -atkinson #000000 #FFFFFF #E63946 #1D3557
+
+* Preview colors in the terminal *
+    metrochrome.py -swatch [-truecolor | -256] [-columns <n>] [-labels] <colors>
+
+    colors may be any mix of:
+    <hex_color> = a single RGB hexadecimal color
+    -gradient <hex_color> <hex_color> <steps> = steps (at least 1) colors evenly spaced between two colors
+    -file <palette_file> = colors listed one per line, - reads standard input
+
+    truecolor escapes are used when COLORTERM is truecolor or 24bit, otherwise the nearest
+    xterm-256 colors; -truecolor and -256 override the choice
+
+    examples:
+    metrochrome.py -swatch -gradient #000000 #FF8800 16
+
+* WCAG contrast ratio *
+    metrochrome.py -contrast <color> <color>
+    metrochrome.py -contrast -file <palette_file> [-level <level>]
+
+    colors are RGB hexadecimal or three quoted RGB values such as "0 0 255"
+    with two colors the ratio is printed followed by the levels it passes
+    with a palette file every pair passing the level is printed as: <color> <color> <ratio>
+    levels: AA (4.5, default), AAA (7), AA-large (3), AAA-large (4.5)
+
+    examples:
+    metrochrome.py -contrast #777777 #FFFFFF  # prints 4.48 AA-large
+
+* Rewrite color literals in stylesheets, SVG and theme files *
+    metrochrome.py -rewrite <out_color_space> <file> ...
+
+    #RRGGBB, rgb(), hsl() and cmyk() literals are converted to -rgbh, -rgb, -hsl or -cmyk
+    #RRGGBB is only converted where it is a value, not in selectors, links or JSON keys
+    files are rewritten in place and the names of changed files are printed
+    a file named - is read from standard input and written to standard output
+
+    examples:
+    metrochrome.py -rewrite -hsl theme.css icons/*.svg
+
+* Convert a file of colors *
+    metrochrome.py -convert <in_color_space> <out_color_space> <in_file> <out_file> [-css] [-cache <dir> | -nocache]
+
+    in_file holds one color per line written as on the command line; use - for standard input or output
+    -css = write colors as CSS style literals such as hsl(120, 100%, 25%) (-rgbh, -rgb, -hsl or -cmyk only)
+    converted chunks of the file are cached (by default in ~/.cache/metrochrome) so a later run
+    only converts the chunks whose lines changed; -cache picks another directory and -nocache
+    disables caching
+
+    examples:
+    metrochrome.py -convert -rgb -rgbh catalog.txt catalog_hex.txt
+
+* Sort a palette *
+    metrochrome.py -sort <order> <in_file>
+
+    in_file is a list of colors or an image as for -histogram; colors are printed as RGB hexadecimal
+    orders:
+    -hue = HSV hue
+    -bands = near grays by lightness, then lightness bands of alternating hue direction
+    -hilbert = position along a Hilbert curve through CIE L*a*b* space
+    -tour = nearest neighbor walk through CIE L*a*b* from the darkest color; much slower than
+            the other orders, about a minute for a million distinct colors
+
+    examples:
+    metrochrome.py -sort -hilbert palette.txt
+
+* Chromatic adaptation between white points *
+    metrochrome.py -adapt <source_white> <destination_white> [<method>] <-rgb | -rgbh | -cie> <in_color>
+    metrochrome.py -adapt <source_white> <destination_white> [<method>] -file <in_file>
+
+    white points: A, C, D50, D55, D65, D75, E, F2, F7, F11
+    methods: -bradford (default), -cat02, -vonkries
+    the adapted color is printed in the input color space; a file of colors, one per line,
+    is printed as RGB hexadecimal
+
+    examples:
+    metrochrome.py -adapt D50 D65 -cie 0.96422 1 0.82521  # prints 0.950 1.000 1.089
 """)
 
 def exitWithError():
@@ -330,7 +479,10 @@ def exitWithError():
 
 def RGB_to_RGBhex(inputRgb):
     """Converts RGB colors to hexadecimal representation"""
-    total = inputRgb.red*65536 + inputRgb.green*256 + inputRgb.blue
+    red = int(inputRgb.red + 0.5)
+    green = int(inputRgb.green + 0.5)
+    blue = int(inputRgb.blue + 0.5)
+    total = red*65536 + green*256 + blue
     return RGBHexColor(total)
 
 def RGB_to_CMYK(inputRgb):
@@ -383,7 +535,7 @@ def RGB_to_HSV(rgb):
     elif green == M:
         hue = ((blue - red) / chroma) + 2
     elif blue == M:
-		hue = ((red - green) / chroma) + 4;
+        hue = ((red - green) / chroma) + 4
 
     hue *= 60.0
 
@@ -404,7 +556,7 @@ def RGB_to_HSL(rgb):
     if lightness == 0.0 or lightness == 1.0:
         saturation = 0.0
     else:
-        saturation = chroma / (1 - abs(2 * lightness - 1))
+        saturation = min(1.0, chroma / (1 - abs(2 * lightness - 1)))
 
     if chroma == 0:
         hue = 0.0
@@ -413,14 +565,17 @@ def RGB_to_HSL(rgb):
     elif green == M:
         hue = ((blue - red) / chroma) + 2
     elif blue == M:
-		hue = ((red - green) / chroma) + 4;
+        hue = ((red - green) / chroma) + 4
 
     hue *= 60.0
 
     return HSLColor(hue, saturation, lightness)
 
 def RGB_to_CIE(rgb):
-    return CIEColor(0.0, 0.0, 0.0)
+    """Converts colors in sRGB color space to CIE XYZ relative to D65 white"""
+    linear = [srgbToLinear(v / 255.0) for v in (rgb.red, rgb.green, rgb.blue)]
+    x, y, z = matrixApply(SRGB_TO_XYZ, linear)
+    return CIEColor(x, min(1.0, y), z)
 
 def RGB_to_wavelength(rgb):
     """Converts RGB color space to wavelength in nm"""
@@ -433,8 +588,8 @@ def RGBhex_to_RGB(rgbHex):
     """Converts RGB hexadecimal representation to standard RGB"""
 
     initial = int(rgbHex.value)
-    red = initial / 65536
-    green = (initial-red*65536) / 256
+    red = initial // 65536
+    green = (initial-red*65536) // 256
     blue = (initial-red*65536-green*256)
 
     return RGBColor(red, green, blue)
@@ -590,9 +745,10 @@ def HSV_to_RGB(hsv):
         green = 0
         blue = x
 
-    red = (red + m) * 255
-    green = (green + m) * 255
-    blue = (blue + m) * 255
+    # Rounding can leave a channel just outside 0-255
+    red = min(255.0, max(0.0, (red + m) * 255))
+    green = min(255.0, max(0.0, (green + m) * 255))
+    blue = min(255.0, max(0.0, (blue + m) * 255))
 
     return RGBColor(red, green, blue)
 
@@ -662,9 +818,10 @@ def HSL_to_RGB(hsl):
         green = 0
         blue = x
 
-    red = (red + m) * 255
-    green = (green + m) * 255
-    blue = (blue + m) * 255
+    # Rounding can leave a channel just outside 0-255
+    red = min(255.0, max(0.0, (red + m) * 255))
+    green = min(255.0, max(0.0, (green + m) * 255))
+    blue = min(255.0, max(0.0, (blue + m) * 255))
 
     return RGBColor(red, green, blue)
 
@@ -699,8 +856,9 @@ def HSL_to_wavelength(hsl):
     return RGB_to_wavelength(rgb)
 
 def CIE_to_RGB(cie):
-    """Converts CIE color space to RGB"""
-    return RGBColor(0, 0, 0)
+    """Converts CIE XYZ relative to D65 white to sRGB, clipping colors outside the sRGB gamut"""
+    linear = matrixApply(XYZ_TO_SRGB, (cie.x, cie.y, cie.z))
+    return RGBColor(*[toByte(linearToSrgb(clampUnit(v))) for v in linear])
 
 def CIE_to_RGBhex(cie):
     """Converts CIE color space to RGB (hexadecimal representation)"""
@@ -732,6 +890,1730 @@ def CIE_to_wavelength(cie):
     rgb = CIE_to_RGB(cie)
     return RGB_to_wavelength(rgb)
 
+def clampUnit(ratio):
+    """Clamps a ratio to the range 0 to 1"""
+    return min(1.0, max(0.0, ratio))
+
+def hueShift(degrees):
+    """Returns an adjustment that rotates the hue of an RGB color through HSV color space"""
+    def adjust(rgb):
+        hsv = RGB_to_HSV(rgb)
+        hsv.hue = (hsv.hue + degrees) % 360.0
+        return HSV_to_RGB(hsv)
+    return adjust
+
+def saturationScale(factor):
+    """Returns an adjustment that scales the HSV saturation of an RGB color"""
+    def adjust(rgb):
+        hsv = RGB_to_HSV(rgb)
+        hsv.saturation = clampUnit(hsv.saturation * factor)
+        return HSV_to_RGB(hsv)
+    return adjust
+
+def valueScale(factor):
+    """Returns an adjustment that scales the HSV value of an RGB color"""
+    def adjust(rgb):
+        hsv = RGB_to_HSV(rgb)
+        hsv.value = clampUnit(hsv.value * factor)
+        return HSV_to_RGB(hsv)
+    return adjust
+
+def lightnessScale(factor):
+    """Returns an adjustment that scales the HSL lightness of an RGB color"""
+    def adjust(rgb):
+        hsl = RGB_to_HSL(rgb)
+        hsl.lightness = clampUnit(hsl.lightness * factor)
+        return HSL_to_RGB(hsl)
+    return adjust
+
+ROUND_TRIPS = {
+    "-cmyk": (RGB_to_CMYK, CMYK_to_RGB),
+    "-cmykr": (RGB_to_CMYKratio, CMYKratio_to_RGB),
+    "-hsv": (RGB_to_HSV, HSV_to_RGB),
+    "-hsl": (RGB_to_HSL, HSL_to_RGB),
+    "-cie": (RGB_to_CIE, CIE_to_RGB),
+}
+
+def viaColorSpace(flag):
+    """Returns an adjustment that converts an RGB color into another color space and back"""
+    forward, backward = ROUND_TRIPS[flag]
+    return lambda rgb: backward(forward(rgb))
+
+ADJUSTMENTS = {
+    "-hue": hueShift,
+    "-saturation": saturationScale,
+    "-value": valueScale,
+    "-lightness": lightnessScale,
+}
+
+def parseAdjustments(args):
+    """Parses pairs of adjustment flags and arguments such as -hue 30 -via -cmyk into a list of adjustments"""
+    if len(args) % 2 != 0:
+        raise InvalidColorException()
+    adjustments = []
+    for i in range(0, len(args), 2):
+        flag = args[i]
+        if flag == "-via" and args[i+1] in ROUND_TRIPS:
+            adjustments.append(viaColorSpace(args[i+1]))
+        elif flag in ADJUSTMENTS:
+            try:
+                amount = float(args[i+1])
+            except ValueError:
+                raise InvalidColorException()
+            adjustments.append(ADJUSTMENTS[flag](amount))
+        else:
+            raise InvalidColorException()
+    return adjustments
+
+def bakeLut(size, adjustments):
+    """Evaluates a chain of adjustments once per point of a size^3 RGB lattice
+
+    Returns a flat array of red, green and blue ratios with red varying fastest, which is the
+    ordering of .cube files.
+    """
+    levels = [255.0 * i / (size - 1) for i in range(size)]
+    table = array("f")
+    for blue in levels:
+        for green in levels:
+            for red in levels:
+                rgb = RGBColor(red, green, blue)
+                for adjust in adjustments:
+                    rgb = adjust(rgb)
+                table.append(rgb.red / 255.0)
+                table.append(rgb.green / 255.0)
+                table.append(rgb.blue / 255.0)
+    return table
+
+def writeCube(filename, size, table, title="metrochrome"):
+    """Writes a 3D LUT to a .cube file one blue plane at a time"""
+    plane = 3 * size * size
+    with open(filename, "w") as out:
+        out.write('TITLE "%s"\nLUT_3D_SIZE %i\nDOMAIN_MIN 0.0 0.0 0.0\nDOMAIN_MAX 1.0 1.0 1.0\n' % (title, size))
+        for start in range(0, len(table), plane):
+            values = table[start:start+plane]
+            out.write("".join(["%.6f %.6f %.6f\n" % (values[i], values[i+1], values[i+2]) for i in range(0, len(values), 3)]))
+
+def makeLut(args):
+    """Handles: metrochrome.py -lut <size> <adjustments> <out_file>"""
+    try:
+        size = int(args[0])
+    except ValueError:
+        exitWithError()
+    if size < 2 or size > 256:
+        exitWithError()
+    try:
+        adjustments = parseAdjustments(args[1:-1])
+    except InvalidColorException:
+        exitWithError()
+    title = " ".join(args[1:-1]) or "identity"
+    try:
+        table = bakeLut(size, adjustments)
+    except InvalidColorException:
+        exitWithError()
+    writeCube(args[-1], size, table, title)
+
+STRIP_PIXELS = 1 << 18
+
+RAW_EXTENSIONS = (".raw", ".rgb")
+
+def isRawImage(filename):
+    """Files named .raw or .rgb hold bare 24 bit RGB pixels, anything else is read as a binary PPM"""
+    return filename.lower().endswith(RAW_EXTENSIONS)
+
+class ImageFile:
+    """An RGB image read in horizontal strips from a binary PPM (P6) file or a raw 24 bit RGB file"""
+    def __init__(self, filename, width=None):
+        self.file = open(filename, "rb")
+        if isRawImage(filename):
+            self.file.seek(0, 2)
+            size = self.file.tell()
+            self.file.seek(0)
+            self.width = width or 1
+            if size % (3 * self.width) != 0:
+                raise InvalidColorException()
+            self.height = size // (3 * self.width)
+        else:
+            self.readHeader()
+        if self.width < 1 or self.height < 1:
+            raise InvalidColorException()
+
+    def readHeader(self):
+        tokens = []
+        while len(tokens) < 4:
+            line = self.file.readline()
+            if not line:
+                raise InvalidColorException()
+            tokens.extend(line.split(b"#")[0].split())
+        if len(tokens) != 4 or tokens[0] != b"P6" or tokens[3] != b"255":
+            raise InvalidColorException()
+        try:
+            self.width = int(tokens[1])
+            self.height = int(tokens[2])
+        except ValueError:
+            raise InvalidColorException()
+
+    def readRows(self, count):
+        return bytearray(self.file.read(3 * self.width * count))
+
+    def strips(self):
+        """Yields the pixels in strips of whole rows holding about STRIP_PIXELS pixels each
+
+        Raises InvalidColorException when the file ends before the last row.
+        """
+        rows = max(1, STRIP_PIXELS // self.width)
+        for top in range(0, self.height, rows):
+            count = min(rows, self.height - top)
+            strip = self.readRows(count)
+            if len(strip) != 3 * self.width * count:
+                raise InvalidColorException()
+            yield strip
+
+    def close(self):
+        self.file.close()
+
+def openImageOutput(filename, width, height):
+    """Opens a temporary file beside an output image for writing, emitting a PPM header unless the
+    name marks a raw file; replaceFile moves it over the output once the image is complete"""
+    directory = os.path.dirname(os.path.abspath(filename))
+    out = tempfile.NamedTemporaryFile("wb", dir=directory, delete=False)
+    if not isRawImage(filename):
+        out.write(b"P6\n%i %i\n255\n" % (width, height))
+    return out
+
+def replaceFile(temporary, filename):
+    """Moves a finished temporary file over a file, keeping its mode or giving a new file the umask default"""
+    if os.path.exists(filename):
+        shutil.copymode(filename, temporary)
+    else:
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(temporary, 0o666 & ~umask)
+    os.replace(temporary, filename)
+
+LUT_CACHE_LIMIT = STRIP_PIXELS
+
+def toByte(ratio):
+    """Converts a ratio to the nearest 8 bit channel value"""
+    return min(255, max(0, int(ratio * 255.0 + 0.5)))
+
+class CubeLut:
+    """A 3D lookup table from a .cube file stored as a flat array of ratios with red varying fastest"""
+    def __init__(self, size, table):
+        self.size = size
+        self.table = table
+        if len(table) != 3 * size ** 3:
+            raise InvalidColorException()
+
+        # Lattice offsets and interpolation weights for every 8 bit channel value
+        scale = (size - 1) / 255.0
+        self.weight = []
+        redOffset = []
+        for v in range(256):
+            i = min(int(v * scale), size - 2)
+            self.weight.append(v * scale - i)
+            redOffset.append(3 * i)
+        self.redOffset = redOffset
+        self.greenOffset = [size * i for i in redOffset]
+        self.blueOffset = [size * size * i for i in redOffset]
+        self.redStep = 3
+        self.greenStep = 3 * size
+        self.blueStep = 3 * size * size
+
+    def tetrahedral(self, red, green, blue):
+        """Interpolates between the four lattice points of the tetrahedron enclosing a color"""
+        t = self.table
+        fr = self.weight[red]
+        fg = self.weight[green]
+        fb = self.weight[blue]
+        c000 = self.redOffset[red] + self.greenOffset[green] + self.blueOffset[blue]
+        c111 = c000 + self.redStep + self.greenStep + self.blueStep
+        if fr > fg:
+            if fg > fb:
+                w0, w1, w2, w3 = 1.0 - fr, fr - fg, fg - fb, fb
+                c1 = c000 + self.redStep
+                c2 = c1 + self.greenStep
+            elif fr > fb:
+                w0, w1, w2, w3 = 1.0 - fr, fr - fb, fb - fg, fg
+                c1 = c000 + self.redStep
+                c2 = c1 + self.blueStep
+            else:
+                w0, w1, w2, w3 = 1.0 - fb, fb - fr, fr - fg, fg
+                c1 = c000 + self.blueStep
+                c2 = c1 + self.redStep
+        else:
+            if fb > fg:
+                w0, w1, w2, w3 = 1.0 - fb, fb - fg, fg - fr, fr
+                c1 = c000 + self.blueStep
+                c2 = c1 + self.greenStep
+            elif fb > fr:
+                w0, w1, w2, w3 = 1.0 - fg, fg - fb, fb - fr, fr
+                c1 = c000 + self.greenStep
+                c2 = c1 + self.blueStep
+            else:
+                w0, w1, w2, w3 = 1.0 - fg, fg - fr, fr - fb, fb
+                c1 = c000 + self.greenStep
+                c2 = c1 + self.redStep
+        return tuple(toByte(w0*t[c000+k] + w1*t[c1+k] + w2*t[c2+k] + w3*t[c111+k]) for k in (0, 1, 2))
+
+    def trilinear(self, red, green, blue):
+        """Interpolates between the eight lattice points of the cube enclosing a color"""
+        t = self.table
+        fr = self.weight[red]
+        fg = self.weight[green]
+        fb = self.weight[blue]
+        c000 = self.redOffset[red] + self.greenOffset[green] + self.blueOffset[blue]
+        c010 = c000 + self.greenStep
+        c001 = c000 + self.blueStep
+        c011 = c001 + self.greenStep
+        r = self.redStep
+        result = []
+        for k in (0, 1, 2):
+            y0 = (t[c000+k] + (t[c000+r+k] - t[c000+k]) * fr) * (1.0 - fg) + (t[c010+k] + (t[c010+r+k] - t[c010+k]) * fr) * fg
+            y1 = (t[c001+k] + (t[c001+r+k] - t[c001+k]) * fr) * (1.0 - fg) + (t[c011+k] + (t[c011+r+k] - t[c011+k]) * fr) * fg
+            result.append(toByte(y0 + (y1 - y0) * fb))
+        return tuple(result)
+
+    def applyToPixels(self, pixels, interpolate, cache):
+        """Maps a buffer of 24 bit RGB pixels through the LUT, interpolating each distinct color once"""
+        get = cache.get
+        parts = []
+        append = parts.append
+        for rgb in zip(pixels[0::3], pixels[1::3], pixels[2::3]):
+            mapped = get(rgb)
+            if mapped is None:
+                if len(cache) >= LUT_CACHE_LIMIT:
+                    cache.clear()
+                mapped = cache[rgb] = bytes(bytearray(interpolate(*rgb)))
+            append(mapped)
+        return b"".join(parts)
+
+def readCube(filename):
+    """Loads a 3D LUT from a .cube file into a CubeLut"""
+    size = None
+    table = array("f")
+    with open(filename) as cube:
+        for line in cube:
+            fields = line.split()
+            if not fields or fields[0].startswith("#"):
+                continue
+            keyword = fields[0]
+            try:
+                if keyword == "LUT_3D_SIZE" and len(fields) == 2:
+                    size = int(fields[1])
+                elif keyword == "DOMAIN_MIN":
+                    if [float(f) for f in fields[1:]] != [0.0, 0.0, 0.0]:
+                        raise InvalidColorException()
+                elif keyword == "DOMAIN_MAX":
+                    if [float(f) for f in fields[1:]] != [1.0, 1.0, 1.0]:
+                        raise InvalidColorException()
+                elif keyword in ("TITLE", "LUT_3D_INPUT_RANGE"):
+                    continue
+                elif len(fields) == 3:
+                    table.extend([float(f) for f in fields])
+                else:
+                    raise InvalidColorException()
+            except ValueError:
+                raise InvalidColorException()
+    if size is None or size < 2 or size > 256:
+        raise InvalidColorException()
+    return CubeLut(size, table)
+
+def applyLut(args):
+    """Handles: metrochrome.py -applylut <lut_file> <in_image> <out_image> [-trilinear]"""
+    if len(args) == 4 and args[3] == "-trilinear":
+        method = "trilinear"
+    elif len(args) == 3 or (len(args) == 4 and args[3] == "-tetrahedral"):
+        method = "tetrahedral"
+    else:
+        exitWithError()
+
+    try:
+        lut = readCube(args[0])
+        image = ImageFile(args[1])
+    except (IOError, ValueError, InvalidColorException):
+        exitWithError()
+
+    interpolate = getattr(lut, method)
+    cache = {}
+    out = openImageOutput(args[2], image.width, image.height)
+    try:
+        for strip in image.strips():
+            out.write(lut.applyToPixels(strip, interpolate, cache))
+    except InvalidColorException:
+        out.close()
+        os.remove(out.name)
+        exitWithError()
+    finally:
+        image.close()
+        out.close()
+    replaceFile(out.name, args[2])
+
+def srgbToLinear(ratio):
+    """Removes the sRGB transfer curve from a channel ratio"""
+    if ratio <= 0.04045:
+        return ratio / 12.92
+    return ((ratio + 0.055) / 1.055) ** 2.4
+
+# Linear light for each 8 bit sRGB channel value
+SRGB_LINEAR = [srgbToLinear(v / 255.0) for v in range(256)]
+
+SRGB_TO_XYZ = ((0.4124564, 0.3575761, 0.1804375),
+               (0.2126729, 0.7151522, 0.0721750),
+               (0.0193339, 0.1191920, 0.9503041))
+
+D65_WHITE = (0.95047, 1.0, 1.08883)
+
+def linearToSrgb(ratio):
+    """Applies the sRGB transfer curve to a linear light ratio"""
+    if ratio <= 0.0031308:
+        return 12.92 * ratio
+    return 1.055 * ratio ** (1.0 / 2.4) - 0.055
+
+def matrixMultiply(a, b):
+    """Multiplies two 3x3 matrices"""
+    return tuple(tuple(sum(a[i][k] * b[k][j] for k in (0, 1, 2)) for j in (0, 1, 2)) for i in (0, 1, 2))
+
+def matrixApply(m, v):
+    """Multiplies a 3x3 matrix by a vector of three values"""
+    return tuple(m[i][0] * v[0] + m[i][1] * v[1] + m[i][2] * v[2] for i in (0, 1, 2))
+
+def matrixInverse(m):
+    """Inverts a 3x3 matrix by cofactors"""
+    (a, b, c), (d, e, f), (g, h, i) = m
+    det = a * (e*i - f*h) - b * (d*i - f*g) + c * (d*h - e*g)
+    return ((( e*i - f*h) / det, -(b*i - c*h) / det, ( b*f - c*e) / det),
+            (-(d*i - f*g) / det, ( a*i - c*g) / det, -(a*f - c*d) / det),
+            (( d*h - e*g) / det, -(a*h - b*g) / det, ( a*e - b*d) / det))
+
+XYZ_TO_SRGB = matrixInverse(SRGB_TO_XYZ)
+
+def labCurve(t):
+    if t > 216.0 / 24389.0:
+        return t ** (1.0 / 3.0)
+    return (24389.0 / 27.0 * t + 16.0) / 116.0
+
+def rgbBytes_to_Lab(red, green, blue):
+    """Converts 8 bit sRGB channel values to a CIE L*a*b* tuple relative to D65 white"""
+    r = SRGB_LINEAR[red]
+    g = SRGB_LINEAR[green]
+    b = SRGB_LINEAR[blue]
+    m = SRGB_TO_XYZ
+    fx = labCurve((m[0][0]*r + m[0][1]*g + m[0][2]*b) / D65_WHITE[0])
+    fy = labCurve((m[1][0]*r + m[1][1]*g + m[1][2]*b) / D65_WHITE[1])
+    fz = labCurve((m[2][0]*r + m[2][1]*g + m[2][2]*b) / D65_WHITE[2])
+    return (116.0 * fy - 16.0, 500.0 * (fx - fy), 200.0 * (fy - fz))
+
+PALETTE_SAMPLES = 1 << 20
+
+def colorHistogram(image, stride=None):
+    """Counts every stride-th pixel of an image into 32^3 quantized RGB bins
+
+    Returns a dict from the center of each bin to a list of its pixel count and the sums of the
+    real red, green and blue values of those pixels, so palette colors are averaged from actual
+    pixels rather than bin centers. The default stride keeps the sample count near
+    PALETTE_SAMPLES however large the image is.
+    """
+    if stride is None:
+        stride = max(1, image.width * image.height // PALETTE_SAMPLES)
+    step = 3 * stride
+    histogram = {}
+    for strip in image.strips():
+        counts = Counter(zip(strip[0::step], strip[1::step], strip[2::step]))
+        for (r, g, b), n in counts.items():
+            key = ((r & 0xF8) | 4, (g & 0xF8) | 4, (b & 0xF8) | 4)
+            entry = histogram.get(key)
+            if entry is None:
+                histogram[key] = [n, r * n, g * n, b * n]
+            else:
+                entry[0] += n
+                entry[1] += r * n
+                entry[2] += g * n
+                entry[3] += b * n
+    return histogram
+
+def weightedMean(bins):
+    """Returns the population weighted mean RGB of (color, count) pairs"""
+    total = sum(count for color, count in bins)
+    return tuple(sum(color[k] * count for color, count in bins) / float(total) for k in (0, 1, 2))
+
+def histogramPoints(histogram, lab=False):
+    """Pairs the coordinates of each histogram bin center in RGB or CIE L*a*b* space with the
+    mean color and count of the pixels in the bin"""
+    points = []
+    for center, (n, red, green, blue) in histogram.items():
+        point = rgbBytes_to_Lab(*center) if lab else center
+        points.append((point, ((red / float(n), green / float(n), blue / float(n)), n)))
+    return points
+
+def medianCut(points, count):
+    """Splits (point, bin) pairs into boxes at the weighted median of their widest axis"""
+    boxes = [points]
+    while len(boxes) < count:
+        best = None
+        for i, box in enumerate(boxes):
+            if len(box) < 2:
+                continue
+            for k in (0, 1, 2):
+                spread = max(p[k] for p, bin in box) - min(p[k] for p, bin in box)
+                if best is None or spread > best[0]:
+                    best = (spread, i, k)
+        if best is None or best[0] == 0:
+            break
+        spread, i, k = best
+        box = sorted(boxes[i], key=lambda entry: entry[0][k])
+        half = sum(bin[1] for p, bin in box) / 2.0
+        seen = 0
+        for split in range(1, len(box)):
+            seen += box[split-1][1][1]
+            if seen >= half:
+                break
+        boxes[i:i+1] = [box[:split], box[split:]]
+    return boxes
+
+KMEANS_BATCH = 1024
+KMEANS_ITERATIONS = 100
+KMEANS_TOLERANCE = 0.05
+
+def nearestIndex(point, centers):
+    """Returns the index of the center closest to a point"""
+    best = 0
+    bestDistance = None
+    for i, center in enumerate(centers):
+        d = (point[0]-center[0])**2 + (point[1]-center[1])**2 + (point[2]-center[2])**2
+        if bestDistance is None or d < bestDistance:
+            best = i
+            bestDistance = d
+    return best
+
+def kMeans(points, count):
+    """Groups (point, bin) pairs with mini-batch k-means seeded from median cut
+
+    Batches are drawn in proportion to bin population and iteration stops once no center
+    moves further than KMEANS_TOLERANCE.
+    """
+    centers = []
+    for box in medianCut(points, count):
+        total = float(sum(bin[1] for p, bin in box))
+        centers.append([sum(p[k] * bin[1] for p, bin in box) / total for k in (0, 1, 2)])
+    coordinates = [p for p, bin in points]
+    weights = [bin[1] for p, bin in points]
+    seen = [0] * len(centers)
+    rng = random.Random(0)
+
+    for iteration in range(KMEANS_ITERATIONS):
+        moved = 0.0
+        for point in rng.choices(coordinates, weights, k=KMEANS_BATCH):
+            i = nearestIndex(point, centers)
+            seen[i] += 1
+            rate = 1.0 / seen[i]
+            center = centers[i]
+            for k in (0, 1, 2):
+                delta = (point[k] - center[k]) * rate
+                center[k] += delta
+                moved = max(moved, abs(delta))
+        if moved < KMEANS_TOLERANCE:
+            break
+
+    clusters = [[] for c in centers]
+    for p, bin in points:
+        clusters[nearestIndex(p, centers)].append((p, bin))
+    return [c for c in clusters if c]
+
+def extractPalette(args):
+    """Handles: metrochrome.py -palette <count> <in_image> [-mediancut | -kmeans] [-lab] [-sample <stride>]"""
+    try:
+        count = int(args[0])
+    except ValueError:
+        exitWithError()
+    method = "-mediancut"
+    lab = False
+    stride = None
+    options = args[2:]
+    while options:
+        flag = options.pop(0)
+        if flag in ("-mediancut", "-kmeans"):
+            method = flag
+        elif flag == "-lab":
+            lab = True
+        elif flag == "-sample" and options:
+            try:
+                stride = int(options.pop(0))
+            except ValueError:
+                exitWithError()
+        else:
+            exitWithError()
+    if count < 1 or (stride is not None and stride < 1):
+        exitWithError()
+
+    try:
+        image = ImageFile(args[1])
+    except (IOError, InvalidColorException):
+        exitWithError()
+    try:
+        histogram = colorHistogram(image, stride)
+    except InvalidColorException:
+        exitWithError()
+    finally:
+        image.close()
+    if not histogram:
+        exitWithError()
+
+    points = histogramPoints(histogram, lab)
+    if method == "-kmeans":
+        groups = kMeans(points, count)
+    else:
+        groups = medianCut(points, count)
+    groups.sort(key=lambda group: -sum(bin[1] for p, bin in group))
+    for group in groups:
+        color = weightedMean([bin for p, bin in group])
+        print(RGB_to_RGBhex(RGBColor(*[int(v + 0.5) for v in color])))
+
+IMAGE_EXTENSIONS = (".ppm", ".pnm") + RAW_EXTENSIONS
+
+def isImageFile(filename):
+    return filename.lower().endswith(IMAGE_EXTENSIONS)
+
+def parseColorLine(line):
+    """Parses a line holding either an RGB hexadecimal color or three RGB values into an RGBColor"""
+    fields = line.split()
+    if len(fields) == 1:
+        rgbHex = RGBHexColor(0)
+        rgbHex.parseString(fields[0])
+        return RGBhex_to_RGB(rgbHex)
+    elif len(fields) == 3:
+        rgb = RGBColor(0,0,0)
+        rgb.parseString(*fields)
+        return rgb
+    raise InvalidColorException()
+
+CHUNK_LINES = 1 << 16
+
+def colorChunks(filename):
+    """Yields Counters of RGB tuples, one per image strip or per CHUNK_LINES lines of a color list
+
+    A filename of - reads the color list from standard input.
+    """
+    if isImageFile(filename):
+        image = ImageFile(filename)
+        try:
+            for strip in image.strips():
+                yield Counter(zip(strip[0::3], strip[1::3], strip[2::3]))
+        finally:
+            image.close()
+        return
+
+    lines = sys.stdin if filename == "-" else open(filename)
+    try:
+        while True:
+            counts = Counter(itertools.islice(lines, CHUNK_LINES))
+            if not counts:
+                break
+            chunk = Counter()
+            for line, count in counts.items():
+                if line.strip():
+                    rgb = parseColorLine(line)
+                    chunk[(rgb.red, rgb.green, rgb.blue)] += count
+            yield chunk
+    finally:
+        if lines is not sys.stdin:
+            lines.close()
+
+HISTOGRAM_SPACES = {
+    "-hsv": (RGB_to_HSV, ("hue", "saturation", "value"), (360.0, 1.0, 1.0)),
+    "-hsl": (RGB_to_HSL, ("hue", "saturation", "lightness"), (360.0, 1.0, 1.0)),
+}
+
+class ChannelHistogram:
+    """Fixed bin histograms with running statistics for the hue and two other channels of a color space
+
+    Hue is circular, so its statistics come from the running mean of (cos h, sin h), and colors
+    with no saturation, whose hue is meaningless, are counted as achromatic instead.
+    """
+    def __init__(self, names, limits, binCounts):
+        self.names = names
+        self.limits = limits
+        self.bins = [[0] * n for n in binCounts]
+        self.count = 0
+        self.mean = [0.0, 0.0, 0.0]
+        self.m2 = [0.0, 0.0, 0.0]
+        self.hueCount = 0
+        self.meanCos = 0.0
+        self.meanSin = 0.0
+
+    def addChunk(self, weightedValues):
+        """Accumulates a list of (channel values, weight) pairs
+
+        The chunk means and sums of squared deviations are merged into the running totals with
+        Chan's parallel update, so only one chunk is ever held in memory.
+        """
+        total = sum(weight for values, weight in weightedValues)
+        if total == 0:
+            return
+        combined = self.count + total
+        for k in (1, 2):
+            bins = self.bins[k]
+            scale = len(bins) / self.limits[k]
+            last = len(bins) - 1
+            mean = sum(values[k] * weight for values, weight in weightedValues) / float(total)
+            m2 = 0.0
+            for values, weight in weightedValues:
+                v = values[k]
+                bins[min(int(v * scale), last)] += weight
+                m2 += weight * (v - mean) ** 2
+            delta = mean - self.mean[k]
+            self.m2[k] += m2 + delta * delta * self.count * total / float(combined)
+            self.mean[k] += delta * total / float(combined)
+        self.count = combined
+
+        bins = self.bins[0]
+        scale = len(bins) / self.limits[0]
+        last = len(bins) - 1
+        hueTotal = 0
+        sumCos = 0.0
+        sumSin = 0.0
+        for values, weight in weightedValues:
+            if values[1] > 0.0:
+                hue = values[0]
+                bins[min(int(hue * scale), last)] += weight
+                hueTotal += weight
+                sumCos += weight * math.cos(math.radians(hue))
+                sumSin += weight * math.sin(math.radians(hue))
+        if hueTotal:
+            hueCombined = self.hueCount + hueTotal
+            self.meanCos += (sumCos - hueTotal * self.meanCos) / hueCombined
+            self.meanSin += (sumSin - hueTotal * self.meanSin) / hueCombined
+            self.hueCount = hueCombined
+
+    def variance(self, k):
+        if self.count == 0:
+            return 0.0
+        return self.m2[k] / self.count
+
+    def hueMean(self):
+        """Returns the circular mean hue in degrees"""
+        hue = math.degrees(math.atan2(self.meanSin, self.meanCos)) % 360.0
+        # A tiny negative angle wraps to exactly 360
+        return 0.0 if hue >= 360.0 else hue
+
+    def resultantLength(self):
+        """Returns the length of the mean hue vector, 1 when all hues agree and near 0 when spread evenly"""
+        return math.hypot(self.meanCos, self.meanSin)
+
+    def toJson(self):
+        channels = {}
+        channels[self.names[0]] = {
+            "bins": self.bins[0],
+            "mean": self.hueMean(),
+            "resultantLength": self.resultantLength(),
+            "circularVariance": 1.0 - self.resultantLength(),
+            "achromatic": self.count - self.hueCount,
+        }
+        for k in (1, 2):
+            channels[self.names[k]] = {"bins": self.bins[k], "mean": self.mean[k], "variance": self.variance(k)}
+        return json.dumps({"count": self.count, "channels": channels}, indent=2)
+
+    def writeBinary(self, filename):
+        """Writes the bin counts of each channel and the achromatic count as unsigned 64 bit integers,
+        then the circular mean and circular variance of hue and the mean and variance of the
+        other two channels as doubles, all little endian"""
+        counts = array("Q", [n for bins in self.bins for n in bins] + [self.count - self.hueCount])
+        stats = array("d", [self.hueMean(), 1.0 - self.resultantLength()] +
+                           [v for k in (1, 2) for v in (self.mean[k], self.variance(k))])
+        if sys.byteorder == "big":
+            counts.byteswap()
+            stats.byteswap()
+        with open(filename, "wb") as out:
+            counts.tofile(out)
+            stats.tofile(out)
+
+def histogram(args):
+    """Handles: metrochrome.py -histogram <-hsv | -hsl> <in_file> [-bins <h> <s> <v>] [-binary <out_file>]"""
+    if args[0] not in HISTOGRAM_SPACES:
+        exitWithError()
+    convert, names, limits = HISTOGRAM_SPACES[args[0]]
+    binCounts = [36, 10, 10]
+    binaryFile = None
+    options = args[2:]
+    while options:
+        flag = options.pop(0)
+        if flag == "-bins" and len(options) >= 3:
+            try:
+                binCounts = [int(options.pop(0)) for k in (0, 1, 2)]
+            except ValueError:
+                exitWithError()
+        elif flag == "-binary" and options:
+            binaryFile = options.pop(0)
+        else:
+            exitWithError()
+    if min(binCounts) < 1:
+        exitWithError()
+
+    result = ChannelHistogram(names, limits, binCounts)
+    try:
+        for chunk in colorChunks(args[1]):
+            weightedValues = []
+            for rgb, weight in chunk.items():
+                color = convert(RGBColor(*rgb))
+                weightedValues.append((tuple(getattr(color, name) for name in names), weight))
+            result.addChunk(weightedValues)
+    except (IOError, InvalidColorException):
+        exitWithError()
+
+    if binaryFile:
+        result.writeBinary(binaryFile)
+    else:
+        print(result.toJson())
+
+DITHER_KERNELS = {
+    "-floydsteinberg": ((1, 0, 7 / 16.0), (-1, 1, 3 / 16.0), (0, 1, 5 / 16.0), (1, 1, 1 / 16.0)),
+    "-atkinson": ((1, 0, 0.125), (2, 0, 0.125), (-1, 1, 0.125), (0, 1, 0.125), (1, 1, 0.125), (0, 2, 0.125)),
+}
+
+NEAREST_CUBE_CACHE = {}
+
+def nearestPaletteCube(palette):
+    """Returns a 32^3 table of the index of the palette color nearest to the center of each cell
+
+    Cells are indexed by the top five bits of red, green and blue. The table is built once per
+    palette and kept in NEAREST_CUBE_CACHE.
+    """
+    key = tuple(palette)
+    cube = NEAREST_CUBE_CACHE.get(key)
+    if cube is not None:
+        return cube
+    centers = [(v << 3) | 4 for v in range(32)]
+    distances = [[[(c - color[k]) ** 2 for c in centers] for k in (0, 1, 2)] for color in palette]
+    cube = bytearray(32768)
+    cell = 0
+    for r in range(32):
+        for g in range(32):
+            for b in range(32):
+                best = None
+                for i, (dr, dg, db) in enumerate(distances):
+                    d = dr[r] + dg[g] + db[b]
+                    if best is None or d < best:
+                        best = d
+                        cube[cell] = i
+                cell += 1
+    NEAREST_CUBE_CACHE[key] = cube
+    return cube
+
+def parsePalette(strings):
+    """Parses RGB hexadecimal strings into a list of (red, green, blue) tuples"""
+    palette = []
+    for string in strings:
+        rgbHex = RGBHexColor(0)
+        rgbHex.parseString(string)
+        rgb = RGBhex_to_RGB(rgbHex)
+        palette.append((rgb.red, rgb.green, rgb.blue))
+    if not palette or len(palette) > 256:
+        raise InvalidColorException()
+    return palette
+
+def ditherImage(image, out, palette, kernel):
+    """Writes an image reduced to a palette, diffusing each pixel's quantization error to its neighbors"""
+    width = image.width
+    cube = nearestPaletteCube(palette)
+    colors = [bytes(bytearray(color)) for color in palette]
+    spread = [(dy, 3 * dx, weight) for dx, dy, weight in kernel]
+    depth = 1 + max(dy for dx, dy, weight in kernel)
+    pad = 3 * max(abs(dx) for dx, dy, weight in kernel)
+    rowLength = 3 * width + 2 * pad
+    errors = [[0.0] * rowLength for i in range(depth)]
+
+    for strip in image.strips():
+        parts = []
+        append = parts.append
+        for start in range(0, len(strip) - 3 * width + 1, 3 * width):
+            current = errors[0]
+            e = pad
+            for i in range(start, start + 3 * width, 3):
+                r = strip[i] + current[e]
+                g = strip[i+1] + current[e+1]
+                b = strip[i+2] + current[e+2]
+                r = 0 if r < 0 else 255 if r > 255 else int(r + 0.5)
+                g = 0 if g < 0 else 255 if g > 255 else int(g + 0.5)
+                b = 0 if b < 0 else 255 if b > 255 else int(b + 0.5)
+                index = cube[(r >> 3) << 10 | (g >> 3) << 5 | (b >> 3)]
+                append(colors[index])
+                pr, pg, pb = palette[index]
+                er = r - pr
+                eg = g - pg
+                eb = b - pb
+                if er or eg or eb:
+                    for dy, dx, weight in spread:
+                        row = errors[dy]
+                        j = e + dx
+                        row[j] += er * weight
+                        row[j+1] += eg * weight
+                        row[j+2] += eb * weight
+                e += 3
+            errors.pop(0)
+            errors.append([0.0] * rowLength)
+        out.write(b"".join(parts))
+
+def dither(args):
+    """Handles: metrochrome.py -dither <in_image> <out_image> [-floydsteinberg | -atkinson] [-width <pixels>] <hex_color> ..."""
+    kernel = DITHER_KERNELS["-floydsteinberg"]
+    width = None
+    strings = []
+    options = args[2:]
+    while options:
+        flag = options.pop(0)
+        if flag in DITHER_KERNELS:
+            kernel = DITHER_KERNELS[flag]
+        elif flag == "-width" and options:
+            try:
+                width = int(options.pop(0))
+            except ValueError:
+                exitWithError()
+        else:
+            strings.append(flag)
+    if isRawImage(args[0]) and (width is None or width < 1):
+        exitWithError()
+
+    try:
+        palette = parsePalette(strings)
+        image = ImageFile(args[0], width)
+    except (IOError, InvalidColorException):
+        exitWithError()
+    out = openImageOutput(args[1], image.width, image.height)
+    try:
+        ditherImage(image, out, palette, kernel)
+    except InvalidColorException:
+        out.close()
+        os.remove(out.name)
+        exitWithError()
+    finally:
+        image.close()
+        out.close()
+    replaceFile(out.name, args[1])
+
+XTERM_CUBE_LEVELS = (0, 95, 135, 175, 215, 255)
+
+def xtermIndex(red, green, blue):
+    """Returns the xterm-256 palette index nearest to an RGB color among the 6x6x6 cube and gray ramp"""
+    cube = []
+    for v in (red, green, blue):
+        cube.append(min(range(6), key=lambda i: abs(XTERM_CUBE_LEVELS[i] - v)))
+    cubeColor = [XTERM_CUBE_LEVELS[i] for i in cube]
+    gray = min(23, max(0, int(((red + green + blue) / 3.0 - 8) / 10.0 + 0.5)))
+    grayLevel = 8 + 10 * gray
+    cubeDistance = sum((c - v) ** 2 for c, v in zip(cubeColor, (red, green, blue)))
+    grayDistance = sum((grayLevel - v) ** 2 for v in (red, green, blue))
+    if grayDistance < cubeDistance:
+        return 232 + gray
+    return 16 + 36 * cube[0] + 6 * cube[1] + cube[2]
+
+XTERM_TABLE = None
+
+def xtermTable():
+    """Returns a table of xterm-256 indices for the 32^3 cells addressed by the top five bits of
+    each channel of a packed RGB hexadecimal value, building it on first use"""
+    global XTERM_TABLE
+    if XTERM_TABLE is None:
+        XTERM_TABLE = bytearray(32768)
+        for r in range(32):
+            for g in range(32):
+                for b in range(32):
+                    XTERM_TABLE[r << 10 | g << 5 | b] = xtermIndex((r << 3) | 4, (g << 3) | 4, (b << 3) | 4)
+    return XTERM_TABLE
+
+class SwatchWriter:
+    """Renders colors as ANSI background blocks into a single buffered write"""
+    def __init__(self, truecolor, stream=None):
+        self.truecolor = truecolor
+        self.stream = stream or sys.stdout
+        self.escapes = {}
+        self.parts = []
+
+    def escape(self, rgb):
+        value = RGB_to_RGBhex(rgb).value
+        sequence = self.escapes.get(value)
+        if sequence is None:
+            if self.truecolor:
+                sequence = "\x1b[48;2;%i;%i;%im" % (value >> 16, (value >> 8) & 255, value & 255)
+            else:
+                index = xtermTable()[(value >> 19) << 10 | ((value >> 11) & 31) << 5 | ((value >> 3) & 31)]
+                sequence = "\x1b[48;5;%im" % index
+            self.escapes[value] = sequence
+        return sequence
+
+    def row(self, colors, block="  ", labels=False):
+        parts = self.parts
+        for rgb in colors:
+            parts.append(self.escape(rgb))
+            parts.append(block)
+            if labels:
+                parts.append("\x1b[0m %s " % RGB_to_RGBhex(rgb))
+        parts.append("\x1b[0m\n")
+
+    def flush(self):
+        self.stream.write("".join(self.parts))
+        self.stream.flush()
+        self.parts = []
+
+def gradient(start, end, steps):
+    """Returns steps RGB colors evenly spaced from start to end"""
+    if steps < 2:
+        return [start]
+    colors = []
+    for i in range(steps):
+        t = i / float(steps - 1)
+        colors.append(RGBColor(int(start.red + (end.red - start.red) * t + 0.5),
+                               int(start.green + (end.green - start.green) * t + 0.5),
+                               int(start.blue + (end.blue - start.blue) * t + 0.5)))
+    return colors
+
+def readColorList(filename):
+    """Reads RGB colors, one per line, from a file or from standard input when filename is -"""
+    lines = sys.stdin if filename == "-" else open(filename)
+    try:
+        return [parseColorLine(line) for line in lines if line.strip()]
+    finally:
+        if lines is not sys.stdin:
+            lines.close()
+
+def swatch(args):
+    """Handles: metrochrome.py -swatch [-truecolor | -256] [-columns <n>] [-labels] <colors>"""
+    truecolor = os.environ.get("COLORTERM", "").lower() in ("truecolor", "24bit")
+    columns = None
+    labels = False
+    colors = []
+    options = list(args)
+    try:
+        while options:
+            flag = options.pop(0)
+            if flag == "-truecolor":
+                truecolor = True
+            elif flag == "-256":
+                truecolor = False
+            elif flag == "-labels":
+                labels = True
+            elif flag == "-columns" and options:
+                columns = int(options.pop(0))
+            elif flag == "-gradient" and len(options) >= 3:
+                start = parseColorLine(options.pop(0))
+                end = parseColorLine(options.pop(0))
+                steps = int(options.pop(0))
+                if steps < 1:
+                    raise InvalidColorException()
+                colors.extend(gradient(start, end, steps))
+            elif flag == "-file" and options:
+                colors.extend(readColorList(options.pop(0)))
+            else:
+                colors.append(parseColorLine(flag))
+    except (IOError, ValueError, InvalidColorException):
+        exitWithError()
+    if columns is None:
+        columns = 4 if labels else 16
+    if not colors or columns < 1:
+        exitWithError()
+
+    writer = SwatchWriter(truecolor)
+    for start in range(0, len(colors), columns):
+        writer.row(colors[start:start+columns], labels=labels)
+    writer.flush()
+
+def relativeLuminance(rgb):
+    """Returns the WCAG relative luminance of an RGB color"""
+    return (0.2126 * SRGB_LINEAR[int(rgb.red)] +
+            0.7152 * SRGB_LINEAR[int(rgb.green)] +
+            0.0722 * SRGB_LINEAR[int(rgb.blue)])
+
+def contrastRatio(rgb1, rgb2):
+    """Returns the WCAG contrast ratio between two RGB colors, from 1 to 21"""
+    l1 = relativeLuminance(rgb1)
+    l2 = relativeLuminance(rgb2)
+    return (max(l1, l2) + 0.05) / (min(l1, l2) + 0.05)
+
+WCAG_LEVELS = (("AA", 4.5), ("AAA", 7.0), ("AA-large", 3.0), ("AAA-large", 4.5))
+
+CONTRAST_CHUNK = 1 << 16
+
+def contrastPairs(colors, threshold, out):
+    """Writes every pair of colors whose contrast ratio is at least threshold
+
+    Colors are sorted by luminance, so the partners passing with a color are the contiguous run
+    of brighter colors found by bisection, and pairs that fail are never visited. Lines are
+    written in chunks of about CONTRAST_CHUNK pairs.
+    """
+    entries = sorted((relativeLuminance(rgb), str(RGB_to_RGBhex(rgb))) for rgb in colors)
+    luminances = [luminance for luminance, name in entries]
+    parts = []
+    pairs = 0
+    for i, (luminance, name) in enumerate(entries):
+        dark = luminance + 0.05
+        start = bisect.bisect_left(luminances, threshold * dark - 0.05, i + 1)
+        for j in range(start, len(entries)):
+            parts.append("%s %s %.2f\n" % (name, entries[j][1], (luminances[j] + 0.05) / dark))
+        pairs += len(entries) - start
+        if len(parts) >= CONTRAST_CHUNK:
+            out.write("".join(parts))
+            parts = []
+    out.write("".join(parts))
+    return pairs
+
+def contrast(args):
+    """Handles: metrochrome.py -contrast <color> <color>   OR   metrochrome.py -contrast -file <palette_file> [-level <level>]"""
+    if args[0] == "-file":
+        threshold = dict(WCAG_LEVELS)["AA"]
+        if len(args) == 4 and args[2] == "-level" and args[3] in dict(WCAG_LEVELS):
+            threshold = dict(WCAG_LEVELS)[args[3]]
+        elif len(args) != 2:
+            exitWithError()
+        try:
+            colors = readColorList(args[1])
+        except (IOError, InvalidColorException):
+            exitWithError()
+        contrastPairs(colors, threshold, sys.stdout)
+    elif len(args) == 2:
+        try:
+            ratio = contrastRatio(parseColorLine(args[0]), parseColorLine(args[1]))
+        except InvalidColorException:
+            exitWithError()
+        passed = [name for name, minimum in WCAG_LEVELS if ratio >= minimum]
+        print("%.2f %s" % (ratio, " ".join(passed)))
+    else:
+        exitWithError()
+
+COLOR_SPACE_NAMES = {
+    "-rgb": "RGB",
+    "-rgbh": "RGBhex",
+    "-cmyk": "CMYK",
+    "-cmykr": "CMYKratio",
+    "-hsv": "HSV",
+    "-hsl": "HSL",
+    "-cie": "CIE",
+}
+
+def converter(source, destination):
+    """Returns the conversion function between two color space flags, e.g. RGB_to_HSL for -rgb and -hsl"""
+    if source == destination:
+        return lambda color: color
+    return globals()["%s_to_%s" % (COLOR_SPACE_NAMES[source], COLOR_SPACE_NAMES[destination])]
+
+def shortNumber(x):
+    return "%g" % round(x, 1)
+
+CSS_FORMATTERS = {
+    "-rgbh": str,
+    "-rgb": lambda c: "rgb(%i, %i, %i)" % (int(c.red + 0.5), int(c.green + 0.5), int(c.blue + 0.5)),
+    "-hsl": lambda c: "hsl(%s, %s%%, %s%%)" % (shortNumber(c.hue), shortNumber(100 * c.saturation), shortNumber(100 * c.lightness)),
+    "-cmyk": lambda c: "cmyk(%s%%, %s%%, %s%%, %s%%)" % tuple(shortNumber(v) for v in (c.cyan, c.magenta, c.yellow, c.key)),
+}
+
+# #RRGGBB only counts in value position (see isValuePosition), so fragment references such as
+# url(#facade), href="#facade" and page.html#facade, selectors such as #decade { and character
+# references such as &#128512; are not colors
+COLOR_LITERAL = re.compile(r"(?<!url\()(?<!url\(\")(?<!url\(')(?<!href=\")(?<!href=')(?<=[:,(\s\"'])"
+                           r"#[0-9a-fA-F]{6}(?=[;,)}\s\"']|$)|\b(rgb|hsl|cmyk)\(([^()]*)\)", re.IGNORECASE)
+
+BLOCK_PUNCTUATION = re.compile(r"[{;}]")
+
+def isValuePosition(text, start, end):
+    """Returns whether the hex literal text[start:end] is a value rather than part of a selector or a key
+
+    A quoted literal must open a value after ":", ",", "[" or "=" and not be followed by ":". Any
+    other literal follows ":", "," or "(" directly or follows whitespace within a "name: value"
+    declaration, and the next brace or semicolon after it must not open a block.
+    """
+    i = start - 1
+    previous = text[i]
+    if previous in "\"'":
+        i -= 1
+        while i >= 0 and text[i].isspace():
+            i -= 1
+        j = end + 1 if text[end:end + 1] == previous else end
+        while j < len(text) and text[j].isspace():
+            j += 1
+        return i >= 0 and text[i] in ":,[=" and text[j:j + 1] != ":"
+    if previous.isspace():
+        while i >= 0 and text[i] not in ":;{}":
+            i -= 1
+        if i < 0 or text[i] != ":":
+            return False
+    block = BLOCK_PUNCTUATION.search(text, end)
+    return block is None or block.group(0) != "{"
+
+def parseColorLiteral(match):
+    """Parses a CSS style color literal matched by COLOR_LITERAL into its color space flag and color"""
+    function = match.group(1)
+    if function is None:
+        rgbHex = RGBHexColor(0)
+        rgbHex.parseString(match.group(0))
+        return "-rgbh", rgbHex
+    fields = match.group(2).replace(",", " ").replace("/", " ").split()
+    function = function.lower()
+    if function == "rgb" and len(fields) == 3:
+        rgb = RGBColor(0,0,0)
+        rgb.parseString(*fields)
+        return "-rgb", rgb
+    elif function == "hsl" and len(fields) == 3 and fields[1].endswith("%") and fields[2].endswith("%"):
+        hue = fields[0][:-3] if fields[0].lower().endswith("deg") else fields[0]
+        hsl = HSLColor(0,0,0)
+        try:
+            hsl.parseString(hue, float(fields[1][:-1]) / 100.0, float(fields[2][:-1]) / 100.0)
+        except ValueError:
+            raise InvalidColorException()
+        return "-hsl", hsl
+    elif function == "cmyk" and len(fields) == 4:
+        cmyk = CMYKColor(0,0,0,0)
+        cmyk.parseString(*[f.rstrip("%") for f in fields])
+        return "-cmyk", cmyk
+    raise InvalidColorException()
+
+class ColorRewriter:
+    """Rewrites color literals in text to one color space, converting each distinct literal once per run"""
+    def __init__(self, destination):
+        self.destination = destination
+        self.format = CSS_FORMATTERS[destination]
+        self.memo = {}
+
+    def replace(self, match):
+        literal = match.group(0)
+        if match.group(1) is None and not isValuePosition(match.string, match.start(), match.end()):
+            return literal
+        replacement = self.memo.get(literal)
+        if replacement is None:
+            try:
+                source, color = parseColorLiteral(match)
+                if source == self.destination:
+                    replacement = literal
+                else:
+                    replacement = self.format(converter(source, self.destination)(color))
+            except InvalidColorException:
+                replacement = literal
+            self.memo[literal] = replacement
+        return replacement
+
+    def rewriteLines(self, lines, out):
+        """Copies lines to out with their literals rewritten and returns whether anything changed"""
+        changed = False
+        for line in lines:
+            rewritten = COLOR_LITERAL.sub(self.replace, line)
+            changed = changed or rewritten != line
+            out.write(rewritten)
+        return changed
+
+    def rewriteFile(self, filename):
+        """Rewrites a file in place through a temporary file, leaving it untouched when nothing changes"""
+        directory = os.path.dirname(os.path.abspath(filename))
+        with open(filename, encoding="utf-8", newline="") as lines:
+            with tempfile.NamedTemporaryFile("w", encoding="utf-8", newline="", dir=directory, delete=False) as out:
+                try:
+                    changed = self.rewriteLines(lines, out)
+                except Exception:
+                    os.remove(out.name)
+                    raise
+        if changed:
+            shutil.copymode(filename, out.name)
+            os.replace(out.name, filename)
+        else:
+            os.remove(out.name)
+        return changed
+
+def rewrite(args):
+    """Handles: metrochrome.py -rewrite <out_color_space> <file> ..."""
+    if args[0] not in CSS_FORMATTERS:
+        exitWithError()
+    rewriter = ColorRewriter(args[0])
+    for filename in args[1:]:
+        try:
+            if filename == "-":
+                rewriter.rewriteLines(sys.stdin, sys.stdout)
+            elif rewriter.rewriteFile(filename):
+                print(filename)
+        except (IOError, UnicodeDecodeError):
+            exitWithError()
+
+COLOR_CLASSES = {
+    "-rgb": (RGBColor, 3),
+    "-rgbh": (RGBHexColor, 1),
+    "-cmyk": (CMYKColor, 4),
+    "-cmykr": (CMYKRatioColor, 4),
+    "-hsv": (HSVColor, 3),
+    "-hsl": (HSLColor, 3),
+    "-cie": (CIEColor, 3),
+}
+
+def parseColor(flag, fields):
+    """Parses the fields of a color written as on the command line for the color space flag"""
+    colorClass, arity = COLOR_CLASSES[flag]
+    if len(fields) != arity:
+        raise InvalidColorException()
+    color = colorClass(*[0] * arity)
+    color.parseString(*fields)
+    return color
+
+# A chunk ends after a line whose CRC has these bits clear, so chunk boundaries move with the
+# content and inserting a line only changes the chunk it lands in
+CHUNK_BOUNDARY_MASK = 0x3FF
+CHUNK_MAX_LINES = 1 << 14
+
+def contentChunks(lines):
+    """Yields lists of lines split at content defined boundaries"""
+    chunk = []
+    for line in lines:
+        chunk.append(line)
+        if zlib.crc32(line.encode("utf-8")) & CHUNK_BOUNDARY_MASK == 0 or len(chunk) >= CHUNK_MAX_LINES:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+class ChunkCache:
+    """Converted chunks stored on disk in files named by a hash of the chunk and conversion settings"""
+    # Bump whenever a conversion or formatter changes its output so stale chunks are never served
+    VERSION = "2"
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def key(self, chunk, settings):
+        digest = hashlib.sha1()
+        digest.update(("%s %s\n" % (self.VERSION, " ".join(settings))).encode("utf-8"))
+        for line in chunk:
+            digest.update(line.encode("utf-8"))
+        return digest.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key[:2], key[2:])
+
+    def get(self, key):
+        try:
+            with open(self.path(key), encoding="utf-8", newline="") as cached:
+                return cached.read()
+        except IOError:
+            return None
+
+    def put(self, key, text):
+        """Stores a converted chunk, writing through a temporary file so readers never see part of it"""
+        path = self.path(key)
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        with tempfile.NamedTemporaryFile("w", encoding="utf-8", newline="", dir=directory, delete=False) as out:
+            out.write(text)
+        os.replace(out.name, path)
+
+def defaultCacheDirectory():
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "metrochrome")
+
+def convertChunk(chunk, source, destination, format, memo):
+    """Converts a chunk of color lines, keeping blank lines and converting each distinct line once"""
+    convert = converter(source, destination)
+    parts = []
+    for line in chunk:
+        fields = line.split()
+        if not fields:
+            parts.append(line)
+            continue
+        key = tuple(fields)
+        converted = memo.get(key)
+        if converted is None:
+            converted = memo[key] = format(convert(parseColor(source, fields)))
+        parts.append(converted + "\n")
+    return "".join(parts)
+
+def convertFile(args):
+    """Handles: metrochrome.py -convert <in_color_space> <out_color_space> <in_file> <out_file> [-css] [-cache <dir> | -nocache]"""
+    source, destination, inFile, outFile = args[:4]
+    if source not in COLOR_CLASSES or destination not in COLOR_CLASSES:
+        exitWithError()
+    formatter = "plain"
+    cache = ChunkCache(defaultCacheDirectory())
+    options = args[4:]
+    while options:
+        flag = options.pop(0)
+        if flag == "-css" and destination in CSS_FORMATTERS:
+            formatter = "css"
+        elif flag == "-cache" and options:
+            cache = ChunkCache(options.pop(0))
+        elif flag == "-nocache":
+            cache = None
+        else:
+            exitWithError()
+    format = CSS_FORMATTERS[destination] if formatter == "css" else str
+    settings = (source, destination, formatter)
+
+    # Output goes to a temporary file that replaces out_file only once every line has converted,
+    # so a bad color never leaves a half written file and in_file may also be out_file
+    try:
+        lines = sys.stdin if inFile == "-" else open(inFile, encoding="utf-8", newline="")
+        if outFile == "-":
+            out = sys.stdout
+        else:
+            directory = os.path.dirname(os.path.abspath(outFile))
+            out = tempfile.NamedTemporaryFile("w", encoding="utf-8", newline="", dir=directory, delete=False)
+    except IOError:
+        exitWithError()
+
+    memo = {}
+    try:
+        for chunk in contentChunks(lines):
+            if cache is None:
+                out.write(convertChunk(chunk, source, destination, format, memo))
+                continue
+            key = cache.key(chunk, settings)
+            text = cache.get(key)
+            if text is None:
+                text = convertChunk(chunk, source, destination, format, memo)
+                cache.put(key, text)
+            out.write(text)
+    except InvalidColorException:
+        if out is not sys.stdout:
+            out.close()
+            os.remove(out.name)
+        exitWithError()
+    finally:
+        if lines is not sys.stdin:
+            lines.close()
+        if out is not sys.stdout:
+            out.close()
+
+    if out is not sys.stdout:
+        replaceFile(out.name, outFile)
+
+def hueKey(rgb):
+    return RGB_to_HSV(RGBColor(*rgb)).hue
+
+SORT_BANDS = 8
+NEUTRAL_CHROMA = 8.0
+
+def bandKey(rgb):
+    """Sorts near neutral colors by lightness, then the rest in lightness bands by hue, reversing
+    the hue direction in every other band so neighboring bands meet at similar hues"""
+    lightness, a, b = rgbBytes_to_Lab(*rgb)
+    if math.hypot(a, b) < NEUTRAL_CHROMA:
+        return (-1, lightness)
+    band = min(SORT_BANDS - 1, int(lightness * SORT_BANDS / 100.0))
+    hue = math.atan2(b, a)
+    return (band, hue if band % 2 == 0 else -hue)
+
+HILBERT_BITS = 8
+
+def hilbertIndex(coordinates, bits):
+    """Returns the distance along a Hilbert curve of a point with integer coordinates of the given bits
+
+    Uses Skilling's transpose algorithm from "Programming the Hilbert curve".
+    """
+    x = list(coordinates)
+    n = len(x)
+    q = 1 << (bits - 1)
+    while q > 1:
+        p = q - 1
+        for i in range(n):
+            if x[i] & q:
+                x[0] ^= p
+            else:
+                t = (x[0] ^ x[i]) & p
+                x[0] ^= t
+                x[i] ^= t
+        q >>= 1
+    for i in range(1, n):
+        x[i] ^= x[i-1]
+    t = 0
+    q = 1 << (bits - 1)
+    while q > 1:
+        if x[n-1] & q:
+            t ^= q - 1
+        q >>= 1
+    index = 0
+    for b in range(bits - 1, -1, -1):
+        for i in range(n):
+            index = (index << 1) | (((x[i] ^ t) >> b) & 1)
+    return index
+
+HILBERT_TABLE = None
+
+def hilbertTable():
+    """Derives the Hilbert curve as a state machine from hilbertIndex, building it on first use
+
+    Entry 8 * state + octant holds the next state shifted left three bits plus the curve digit
+    of that octant, so an index costs one lookup per bit. States are found by walking prefixes
+    of a deep curve and telling them apart by the digits of the two levels below each prefix.
+    """
+    global HILBERT_TABLE
+    if HILBERT_TABLE is not None:
+        return HILBERT_TABLE
+    depth = 12
+
+    def digits(prefix, levels):
+        result = []
+        for tail in range(8 ** levels):
+            octants = prefix + [(tail >> 3 * (levels - 1 - i)) & 7 for i in range(levels)]
+            point = [0, 0, 0]
+            for level, octant in enumerate(octants):
+                for k in (0, 1, 2):
+                    point[k] |= ((octant >> (2 - k)) & 1) << (depth - 1 - level)
+            index = hilbertIndex(point, depth)
+            result.append((index >> 3 * (depth - len(octants))) & (8 ** levels - 1))
+        return tuple(result)
+
+    states = {}
+    prefixes = []
+    pending = [[]]
+    while pending:
+        prefix = pending.pop(0)
+        signature = digits(prefix, 2)
+        if signature not in states:
+            states[signature] = len(prefixes)
+            prefixes.append(prefix)
+            pending.extend(prefix + [octant] for octant in range(8))
+    table = []
+    for prefix in prefixes:
+        first = digits(prefix, 1)
+        for octant in range(8):
+            table.append(states[digits(prefix + [octant], 2)] << 3 | first[octant])
+    HILBERT_TABLE = table
+    return table
+
+def hilbertKey(rgb):
+    lightness, a, b = rgbBytes_to_Lab(*rgb)
+    top = (1 << HILBERT_BITS) - 1
+    x, y, z = [min(top, max(0, int(c * top + 0.5))) for c in
+               (lightness / 100.0, (a + 128.0) / 256.0, (b + 128.0) / 256.0)]
+    table = hilbertTable()
+    state = 0
+    index = 0
+    for bit in range(HILBERT_BITS - 1, -1, -1):
+        entry = table[state | ((x >> bit) & 1) << 2 | ((y >> bit) & 1) << 1 | ((z >> bit) & 1)]
+        index = index << 3 | (entry & 7)
+        state = entry & ~7
+    return index
+
+TOUR_CELLS_PER_COLOR = 8
+
+SHELL_OFFSETS = []
+
+def shellOffsets(r):
+    """Returns the offsets of the cells at Chebyshev distance r from a cell, built once per distance"""
+    while len(SHELL_OFFSETS) <= r:
+        n = len(SHELL_OFFSETS)
+        span = range(-n, n + 1)
+        SHELL_OFFSETS.append([(dx, dy, dz) for dx in span for dy in span for dz in span
+                              if max(abs(dx), abs(dy), abs(dz)) == n])
+    return SHELL_OFFSETS[r]
+
+class LabGrid:
+    """Unvisited colors bucketed into cubic cells of L*a*b* space for nearest neighbor searches"""
+    def __init__(self, points):
+        self.remaining = len(points)
+        self.cells = max(1, min(256, int(round((len(points) * TOUR_CELLS_PER_COLOR) ** (1.0 / 3.0)))))
+        self.low = [min(p[k] for p in points) for k in (0, 1, 2)]
+        high = [max(p[k] for p in points) for k in (0, 1, 2)]
+        self.size = max(max(high[k] - self.low[k] for k in (0, 1, 2)) / self.cells, 1e-9)
+        self.buckets = {}
+        for p in points:
+            self.buckets.setdefault(self.cell(p), set()).add(p)
+
+    def cell(self, p):
+        top = self.cells - 1
+        return tuple(min(top, int((p[k] - self.low[k]) / self.size)) for k in (0, 1, 2))
+
+    def remove(self, p):
+        key = self.cell(p)
+        bucket = self.buckets[key]
+        bucket.discard(p)
+        if not bucket:
+            del self.buckets[key]
+        self.remaining -= 1
+
+    def nearest(self, p):
+        """Searches shells of cells around p until no closer color can lie further out
+
+        Once a shell holds more cells than there are occupied buckets, the occupied buckets are
+        scanned directly, so far jumps late in a tour do not sweep through empty cells.
+        """
+        cx, cy, cz = self.cell(p)
+        best = None
+        bestDistance = None
+        for r in range(self.cells):
+            if r and (2 * r + 1) ** 3 - (2 * r - 1) ** 3 > len(self.buckets):
+                for bucket in self.buckets.values():
+                    for q in bucket:
+                        d = (p[0]-q[0])**2 + (p[1]-q[1])**2 + (p[2]-q[2])**2
+                        if bestDistance is None or d < bestDistance:
+                            best = q
+                            bestDistance = d
+                break
+            get = self.buckets.get
+            for dx, dy, dz in shellOffsets(r):
+                bucket = get((cx + dx, cy + dy, cz + dz))
+                if bucket:
+                    for q in bucket:
+                        d = (p[0]-q[0])**2 + (p[1]-q[1])**2 + (p[2]-q[2])**2
+                        if bestDistance is None or d < bestDistance:
+                            best = q
+                            bestDistance = d
+            if best is not None and bestDistance <= (r * self.size) ** 2:
+                break
+        return best
+
+def nearestNeighborTour(colors):
+    """Orders colors by repeatedly stepping to the closest unvisited color in L*a*b*, starting from the darkest
+
+    The grid is rebuilt more coarsely as it empties so searches do not wade through empty cells.
+    """
+    if not colors:
+        return []
+    labs = {}
+    for rgb in colors:
+        labs.setdefault(rgbBytes_to_Lab(*rgb), []).append(rgb)
+    points = list(labs)
+    grid = LabGrid(points)
+    current = min(points)
+    tour = []
+    while current is not None:
+        tour.extend(labs[current])
+        grid.remove(current)
+        if grid.cells > 1 and 0 < grid.remaining * TOUR_CELLS_PER_COLOR * 8 < grid.cells ** 3:
+            grid = LabGrid([q for bucket in grid.buckets.values() for q in bucket])
+        current = grid.nearest(current) if grid.remaining else None
+    return tour
+
+SORT_KEYS = {
+    "-hue": hueKey,
+    "-bands": bandKey,
+    "-hilbert": hilbertKey,
+}
+
+def sortColors(args):
+    """Handles: metrochrome.py -sort <-hue | -bands | -hilbert | -tour> <in_file>"""
+    if len(args) != 2 or (args[0] not in SORT_KEYS and args[0] != "-tour"):
+        exitWithError()
+    counts = Counter()
+    try:
+        for chunk in colorChunks(args[1]):
+            counts.update(chunk)
+    except (IOError, InvalidColorException):
+        exitWithError()
+
+    if args[0] == "-tour":
+        ordered = nearestNeighborTour(list(counts))
+    else:
+        keys = dict((rgb, SORT_KEYS[args[0]](rgb)) for rgb in counts)
+        ordered = sorted(counts, key=keys.get)
+
+    parts = []
+    for rgb in ordered:
+        parts.append(("#%0.6X\n" % (rgb[0] << 16 | rgb[1] << 8 | rgb[2])) * counts[rgb])
+        if len(parts) >= CHUNK_LINES:
+            sys.stdout.write("".join(parts))
+            parts = []
+    sys.stdout.write("".join(parts))
+
+# White points of CIE standard illuminants for the 2 degree observer
+ILLUMINANTS = {
+    "A": (1.09850, 1.0, 0.35585),
+    "C": (0.98074, 1.0, 1.18232),
+    "D50": (0.96422, 1.0, 0.82521),
+    "D55": (0.95682, 1.0, 0.92149),
+    "D65": D65_WHITE,
+    "D75": (0.94972, 1.0, 1.22638),
+    "E": (1.0, 1.0, 1.0),
+    "F2": (0.99187, 1.0, 0.67395),
+    "F7": (0.95044, 1.0, 1.08755),
+    "F11": (1.00966, 1.0, 0.64370),
+}
+
+# Cone response matrices used by each chromatic adaptation method
+ADAPTATION_METHODS = {
+    "-bradford": ((0.8951, 0.2664, -0.1614),
+                  (-0.7502, 1.7135, 0.0367),
+                  (0.0389, -0.0685, 1.0296)),
+    "-cat02": ((0.7328, 0.4296, -0.1624),
+               (-0.7036, 1.6975, 0.0061),
+               (0.0030, 0.0136, 0.9834)),
+    "-vonkries": ((0.40024, 0.70760, -0.08081),
+                  (-0.22630, 1.16532, 0.04570),
+                  (0.0, 0.0, 0.91822)),
+}
+
+ADAPTATION_CACHE = {}
+
+def adaptationMatrix(source, destination, method):
+    """Returns the XYZ matrix adapting colors seen under the source white to the destination white"""
+    cone = ADAPTATION_METHODS[method]
+    sourceCone = matrixApply(cone, ILLUMINANTS[source])
+    destinationCone = matrixApply(cone, ILLUMINANTS[destination])
+    scale = tuple(tuple(destinationCone[i] / sourceCone[i] if i == j else 0.0 for j in (0, 1, 2)) for i in (0, 1, 2))
+    return matrixMultiply(matrixInverse(cone), matrixMultiply(scale, cone))
+
+def linearRgbAdaptation(source, destination, method):
+    """Returns the single linear sRGB matrix for RGB to XYZ, adaptation and XYZ back to RGB
+
+    Matrices are built once per (source, destination, method) and kept in ADAPTATION_CACHE.
+    """
+    key = (source, destination, method)
+    matrix = ADAPTATION_CACHE.get(key)
+    if matrix is None:
+        adapt = adaptationMatrix(source, destination, method)
+        matrix = ADAPTATION_CACHE[key] = matrixMultiply(XYZ_TO_SRGB, matrixMultiply(adapt, SRGB_TO_XYZ))
+    return matrix
+
+def adaptRGB(rgb, matrix):
+    """Applies a linear sRGB matrix to 8 bit RGB values, clipping to the sRGB gamut"""
+    linear = matrixApply(matrix, [SRGB_LINEAR[int(v + 0.5)] for v in rgb])
+    return tuple(toByte(linearToSrgb(clampUnit(v))) for v in linear)
+
+def adaptFile(filename, matrix):
+    """Prints the adapted colors of a color list as RGB hexadecimal, adapting each distinct line once"""
+    lines = sys.stdin if filename == "-" else open(filename)
+    memo = {}
+    try:
+        while True:
+            parts = []
+            for line in itertools.islice(lines, CHUNK_LINES):
+                adapted = memo.get(line)
+                if adapted is None:
+                    if line.strip():
+                        rgb = parseColorLine(line)
+                        r, g, b = adaptRGB((rgb.red, rgb.green, rgb.blue), matrix)
+                        adapted = "#%0.6X\n" % (r << 16 | g << 8 | b)
+                    else:
+                        adapted = line
+                    memo[line] = adapted
+                parts.append(adapted)
+            if not parts:
+                break
+            sys.stdout.write("".join(parts))
+    finally:
+        if lines is not sys.stdin:
+            lines.close()
+
+def adapt(args):
+    """Handles: metrochrome.py -adapt <source_white> <destination_white> [<method>] <-rgb | -rgbh | -cie> <in_color>
+             OR metrochrome.py -adapt <source_white> <destination_white> [<method>] -file <in_file>"""
+    source, destination = args[0], args[1]
+    if source not in ILLUMINANTS or destination not in ILLUMINANTS:
+        exitWithError()
+    method = "-bradford"
+    rest = args[2:]
+    if rest and rest[0] in ADAPTATION_METHODS:
+        method = rest.pop(0)
+    if not rest:
+        exitWithError()
+    flag = rest.pop(0)
+
+    try:
+        if flag == "-file" and len(rest) == 1:
+            adaptFile(rest[0], linearRgbAdaptation(source, destination, method))
+        elif flag == "-cie":
+            cie = parseColor(flag, rest)
+            x, y, z = matrixApply(adaptationMatrix(source, destination, method), (cie.x, cie.y, cie.z))
+            print(CIEColor(x, min(1.0, y), z))
+        elif flag in ("-rgb", "-rgbh"):
+            rgb = converter(flag, "-rgb")(parseColor(flag, rest))
+            adapted = RGBColor(*adaptRGB((rgb.red, rgb.green, rgb.blue), linearRgbAdaptation(source, destination, method)))
+            print(converter("-rgb", flag)(adapted))
+        else:
+            exitWithError()
+    except (IOError, InvalidColorException):
+        exitWithError()
+
 def main():
 
     if len(sys.argv) == 2 and (sys.argv[1] == "-h" or sys.argv[1] == "-help"):
@@ -910,6 +2792,39 @@ def main():
         else:
             exitWithError()
 
+    elif len(sys.argv) >= 4 and sys.argv[1] == "-lut":
+        makeLut(sys.argv[2:])
+
+    elif len(sys.argv) >= 5 and sys.argv[1] == "-applylut":
+        applyLut(sys.argv[2:])
+
+    elif len(sys.argv) >= 4 and sys.argv[1] == "-palette":
+        extractPalette(sys.argv[2:])
+
+    elif len(sys.argv) >= 4 and sys.argv[1] == "-histogram":
+        histogram(sys.argv[2:])
+
+    elif len(sys.argv) >= 5 and sys.argv[1] == "-dither":
+        dither(sys.argv[2:])
+
+    elif len(sys.argv) >= 3 and sys.argv[1] == "-swatch":
+        swatch(sys.argv[2:])
+
+    elif len(sys.argv) >= 4 and sys.argv[1] == "-contrast":
+        contrast(sys.argv[2:])
+
+    elif len(sys.argv) >= 4 and sys.argv[1] == "-rewrite":
+        rewrite(sys.argv[2:])
+
+    elif len(sys.argv) >= 6 and sys.argv[1] == "-convert":
+        convertFile(sys.argv[2:])
+
+    elif len(sys.argv) == 4 and sys.argv[1] == "-sort":
+        sortColors(sys.argv[2:])
+
+    elif len(sys.argv) >= 6 and sys.argv[1] == "-adapt":
+        adapt(sys.argv[2:])
+
     else:
         exitWithError()
 